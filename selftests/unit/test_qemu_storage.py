@@ -0,0 +1,435 @@
+#!/usr/bin/python
+
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+from unittest import mock
+
+from avocado.utils.process import CmdResult
+
+# simple magic for using scripts within a source tree
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.isdir(os.path.join(basedir, 'virttest')):
+    sys.path.append(basedir)
+
+from virttest import qemu_storage
+from virttest import utils_params
+
+
+def _run_qemu_img(cmd, **kwargs):
+    return CmdResult(cmd, exit_status=0)
+
+
+class ParameterAssemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.assembler = qemu_storage._ParameterAssembler(
+            {"image_format": "-f",
+             "backing_file": "-b",
+             "unsafe": "-u"})
+
+    def test_drop_empty_fields(self):
+        cmd = self.assembler.vformat(
+            "create {secret_object} {image_format} {backing_file} "
+            "{image_filename} {image_size}", (),
+            {"secret_object": "", "image_format": "qcow2",
+             "image_filename": "a.qcow2", "image_size": "1G"})
+        self.assertEqual(cmd, "create -f qcow2 a.qcow2 1G")
+
+    def test_drop_none_parameter(self):
+        cmd = self.assembler.vformat(
+            "rebase {image_format} {backing_file} {image_filename}", (),
+            {"image_format": None, "backing_file": None,
+             "image_filename": "a.qcow2"})
+        self.assertEqual(cmd, "rebase a.qcow2")
+
+    def test_bool_conversion(self):
+        template = "rebase {unsafe!b} {image_filename}"
+        self.assertEqual(
+            self.assembler.vformat(template, (),
+                                   {"unsafe": True,
+                                    "image_filename": "a.qcow2"}),
+            "rebase -u a.qcow2")
+        self.assertEqual(
+            self.assembler.vformat(template, (),
+                                   {"unsafe": False,
+                                    "image_filename": "a.qcow2"}),
+            "rebase a.qcow2")
+
+    def test_literal_and_field_in_one_word(self):
+        cmd = self.assembler.vformat(
+            "dd {image_format} if={image_filename} of={target_image_filename}",
+            (), {"image_format": "raw", "image_filename": "a.raw",
+                 "target_image_filename": "b.raw"})
+        self.assertEqual(cmd, "dd -f raw if=a.raw of=b.raw")
+
+    def test_missing_field(self):
+        self.assertRaises(KeyError, self.assembler.vformat,
+                          "info {image_filename}", (), {})
+
+    def test_positional_and_nested_fields(self):
+        cmd = self.assembler.vformat(
+            "{} {image_format} {0} {1[0]} {image.filename}", ("info", ["-U"]),
+            {"image_format": "qcow2",
+             "image": mock.Mock(filename="a.qcow2")})
+        self.assertEqual(cmd, "info -f qcow2 info -U a.qcow2")
+
+    def test_quoted_json_value(self):
+        image_json = ("'json:{\"file\": {\"driver\": \"file\", "
+                      "\"filename\": \"/tmp/a b.qcow2\"}, "
+                      "\"driver\": \"qcow2\"}'")
+        cmd = self.assembler.vformat(
+            "check {image_format} {image_filename}", (),
+            {"image_filename": image_json})
+        self.assertEqual(cmd, "check %s" % image_json)
+
+    def test_format_keywords(self):
+        self.assertEqual(
+            self.assembler.format("commit {image_format} {image_filename}",
+                                  image_format="qcow2",
+                                  image_filename="a.qcow2"),
+            "commit -f qcow2 a.qcow2")
+
+
+_QEMU_IMG_HELP = """qemu-img version 6.0.0
+usage: qemu-img [standard options] command [command options]
+QEMU disk image utility
+
+Command syntax:
+  amend [--object objectdef] [--image-opts] [-p] [-q] [-f fmt] [-t cache] \
+[--force] -o options filename
+  check [--object objectdef] [--image-opts] [-q] [-f fmt] [--output=ofmt] \
+[-r [leaks | all]] [-T src_cache] [-U] filename
+  measure [--output=ofmt] [-O output_fmt] [-o options] [--size N | \
+[--object objectdef] [--image-opts] [-f fmt] [-l snapshot_param] filename]
+
+Command parameters:
+  '--image-opts' indicates that the filename parameter is to be interpreted
+  '-U' disables the check for the image being in use by another process
+"""
+
+
+class QemuImgSupportCmdTest(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            mock.patch.dict(qemu_storage._HELP_TEXT_CACHE, clear=True),
+            mock.patch.object(qemu_storage.utils_misc, "get_qemu_img_binary",
+                              return_value="/usr/bin/qemu-img"),
+            mock.patch.object(qemu_storage.process, "run",
+                              return_value=CmdResult(
+                                  "/usr/bin/qemu-img -h",
+                                  _QEMU_IMG_HELP.encode(), exit_status=0))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        params = utils_params.Params({"image_name": "images/image1",
+                                      "image_format": "qcow2"})
+        self.image = qemu_storage.QemuImg(params, "/tmp", "image1")
+
+    def test_sub_command(self):
+        self.assertTrue(self.image.support_cmd("amend"))
+        self.assertTrue(self.image.support_cmd("measure"))
+        self.assertEqual(self.image._supported_cmds,
+                         frozenset(["amend", "check", "measure"]))
+
+    def test_help_text_fallback(self):
+        self.assertTrue(self.image.support_cmd("--image-opts"))
+        self.assertTrue(self.image.support_cmd("-U"))
+
+    def test_unsupported(self):
+        self.assertFalse(self.image.support_cmd("bitmap"))
+
+    def test_help_probed_once(self):
+        self.image.support_cmd("amend")
+        self.image.support_cmd("--image-opts")
+        qemu_storage.QemuImg(self.image.params, "/tmp",
+                             "image1").support_cmd("check")
+        self.assertEqual(qemu_storage.process.run.call_count, 1)
+
+    def test_failed_help_not_cached(self):
+        qemu_storage.process.run.return_value = CmdResult(
+            "/usr/bin/qemu-img -h", exit_status=1)
+        self.assertFalse(self.image.support_cmd("amend"))
+        qemu_storage.process.run.return_value = CmdResult(
+            "/usr/bin/qemu-img -h", _QEMU_IMG_HELP.encode(), exit_status=0)
+        self.assertTrue(qemu_storage.QemuImg(self.image.params, "/tmp",
+                                             "image1").support_cmd("amend"))
+
+
+class QemuImgCheckCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_filename = os.path.join(self.tmp_dir, "image1.qcow2")
+        with open(self.image_filename, "w") as image:
+            image.write("qcow2")
+        self.params = utils_params.Params(
+            {"image_name": os.path.join(self.tmp_dir, "image1"),
+             "image_format": "qcow2",
+             "image_check_cache": "yes"})
+        patchers = [
+            mock.patch.dict(qemu_storage._HELP_TEXT_CACHE, clear=True),
+            mock.patch.object(qemu_storage.data_dir, "get_tmp_dir",
+                              return_value=self.tmp_dir),
+            # any existing file works as the qemu-img binary
+            mock.patch.object(qemu_storage.utils_misc, "get_qemu_img_binary",
+                              return_value=sys.executable),
+            mock.patch.object(qemu_storage.process, "run",
+                              side_effect=_run_qemu_img)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.image = qemu_storage.QemuImg(self.params, self.tmp_dir, "image1")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _check_image(self):
+        """Check the image, return True if qemu-img check was run."""
+        with mock.patch.object(self.image, "check",
+                               return_value=CmdResult(exit_status=0)) as check:
+            self.image.check_image(self.params, self.tmp_dir)
+        return check.called
+
+    def test_skip_unchanged_image(self):
+        self.assertTrue(self._check_image())
+        self.assertFalse(self._check_image())
+
+    def test_check_changed_image(self):
+        self.assertTrue(self._check_image())
+        stat = os.stat(self.image_filename)
+        os.utime(self.image_filename,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.assertTrue(self._check_image())
+        self.assertFalse(self._check_image())
+
+    def test_cache_disabled(self):
+        self.params["image_check_cache"] = "no"
+        self.assertTrue(self._check_image())
+        self.assertTrue(self._check_image())
+
+    def test_failed_check_not_cached(self):
+        with mock.patch.object(self.image, "check",
+                               return_value=CmdResult(exit_status=3)):
+            self.assertRaises(qemu_storage.exceptions.TestWarn,
+                              self.image.check_image, self.params,
+                              self.tmp_dir)
+        self.assertTrue(self._check_image())
+
+    def test_non_regular_file_not_cached(self):
+        # e.g. a raw device, whose size/mtime do not follow its content
+        os.unlink(self.image_filename)
+        os.mkfifo(self.image_filename)
+        self.assertTrue(self._check_image())
+        self.assertTrue(self._check_image())
+
+
+class QemuImgMeasureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_filename = os.path.join(self.tmp_dir, "image1.qcow2")
+        with open(self.image_filename, "w") as image:
+            image.write("qcow2")
+        self.params = utils_params.Params(
+            {"images": "image1",
+             "image_name": os.path.join(self.tmp_dir, "image1"),
+             "image_format": "qcow2",
+             "image_size": "1G",
+             "image_measure_cache": "yes"})
+        patchers = [
+            mock.patch.dict(qemu_storage._MEASURE_CACHE, clear=True),
+            # any existing file works as the qemu-img binary
+            mock.patch.object(qemu_storage.utils_misc, "get_qemu_img_binary",
+                              return_value=sys.executable),
+            mock.patch.object(qemu_storage.process, "run",
+                              side_effect=_run_qemu_img)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _measure(self, params=None, size=None, target_fmt="qcow2"):
+        """Measure the image, return True if qemu-img measure was run."""
+        image = qemu_storage.QemuImg(params or self.params, self.tmp_dir,
+                                     "image1")
+        call_count = qemu_storage.process.run.call_count
+        image.measure(target_fmt, size=size)
+        return qemu_storage.process.run.call_count > call_count
+
+    def test_reuse_unchanged_image(self):
+        self.assertTrue(self._measure())
+        self.assertFalse(self._measure())
+
+    def test_measure_changed_image(self):
+        self.assertTrue(self._measure())
+        stat = os.stat(self.image_filename)
+        os.utime(self.image_filename,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.assertTrue(self._measure())
+        self.assertFalse(self._measure())
+
+    def test_backing_image_not_cached(self):
+        params = self.params.copy()
+        params["image_chain"] = "base image1"
+        self.assertTrue(self._measure(params))
+        self.assertTrue(self._measure(params))
+
+    def test_data_file_not_cached(self):
+        params = self.params.copy()
+        params["enable_data_file"] = "yes"
+        self.assertTrue(self._measure(params))
+        self.assertTrue(self._measure(params))
+
+    def test_size_not_cached(self):
+        self.assertTrue(self._measure(size="1G"))
+        self.assertTrue(self._measure(size="1G"))
+
+    def test_non_regular_file_not_cached(self):
+        os.unlink(self.image_filename)
+        os.mkfifo(self.image_filename)
+        self.assertTrue(self._measure())
+        self.assertTrue(self._measure())
+
+    def test_evict_oldest_result(self):
+        with mock.patch.object(qemu_storage, "_MEASURE_CACHE_SIZE", 2):
+            self.assertTrue(self._measure())
+            self.assertTrue(self._measure(target_fmt="raw"))
+            self.assertTrue(self._measure(target_fmt="qed"))
+            self.assertFalse(self._measure(target_fmt="qed"))
+            self.assertEqual(len(qemu_storage._MEASURE_CACHE), 2)
+            self.assertTrue(self._measure())
+
+
+class _FakeMonitor(object):
+    """Fake pyudev monitor, moving the fake clock on every poll."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.timeouts = []
+
+    def poll(self, timeout=None):
+        self.timeouts.append(timeout)
+        self.clock[0] += timeout
+
+
+class IscsidevWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = [100.0]
+        patchers = [
+            mock.patch.object(qemu_storage.storage.iscsi.Iscsi, "create_iSCSI",
+                              return_value=mock.Mock()),
+            mock.patch.object(qemu_storage.time, "monotonic",
+                              side_effect=lambda: self.clock[0]),
+            mock.patch.object(qemu_storage.utils_misc, "wait_for",
+                              return_value="/dev/sdb")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        params = utils_params.Params({"image_name": "images/image1",
+                                      "image_format": "raw",
+                                      "iscsi_init_timeout": "3"})
+        self.iscsidev = qemu_storage.Iscsidev(params, "/tmp", "image1")
+        self.iscsidevice = self.iscsidev.iscsidevice
+        self.iscsidevice.logged_in.return_value = False
+        self.monitor = _FakeMonitor(self.clock)
+
+    def test_device_after_event(self):
+        self.iscsidevice.get_device_name.side_effect = [None, "/dev/sdb"]
+        self.assertEqual(self.iscsidev._wait_for_device_name(self.monitor),
+                         "/dev/sdb")
+        self.assertEqual(self.monitor.timeouts, [1.0])
+
+    def test_timeout(self):
+        self.iscsidevice.get_device_name.return_value = ""
+        self.assertIsNone(self.iscsidev._wait_for_device_name(self.monitor))
+        self.assertEqual(self.monitor.timeouts, [1.0, 1.0, 1.0])
+
+    def test_setup_with_monitor(self):
+        self.iscsidevice.get_device_name.return_value = "/dev/sdb"
+        with mock.patch.object(qemu_storage, "pyudev") as pyudev:
+            self.assertEqual(self.iscsidev.setup(), "/dev/sdb")
+        pyudev.Monitor.from_netlink.return_value.start.assert_called_once_with()
+        self.iscsidevice.login.assert_called_once_with()
+        qemu_storage.utils_misc.wait_for.assert_not_called()
+
+    def _assert_setup_polls(self):
+        self.assertEqual(self.iscsidev.setup(), "/dev/sdb")
+        self.iscsidevice.login.assert_called_once_with()
+        qemu_storage.utils_misc.wait_for.assert_called_once_with(
+            self.iscsidevice.get_device_name, 3)
+
+    def test_setup_without_libudev(self):
+        for exc in (ImportError, OSError):
+            for target in ("Context", "Monitor.from_netlink"):
+                self.iscsidevice.login.reset_mock()
+                qemu_storage.utils_misc.wait_for.reset_mock()
+                with self.subTest(exc=exc, target=target), \
+                        mock.patch.object(qemu_storage, "pyudev") as pyudev:
+                    attr = pyudev
+                    for name in target.split("."):
+                        attr = getattr(attr, name)
+                    attr.side_effect = exc
+                    self._assert_setup_polls()
+
+    def test_setup_without_pyudev(self):
+        with mock.patch.object(qemu_storage, "pyudev", None):
+            self._assert_setup_polls()
+
+
+class QemuImgCmdFormatterTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(qemu_storage.utils_misc,
+                                    "get_qemu_img_binary",
+                                    return_value="/usr/bin/qemu-img")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.params = utils_params.Params({"image_name": "images/image1",
+                                           "image_format": "qcow2"})
+
+    def test_shared_by_class(self):
+        image1 = qemu_storage.QemuImg(self.params, "/tmp", "image1")
+        image2 = qemu_storage.QemuImg(self.params, "/tmp", "image1")
+        self.assertIs(image1._cmd_formatter, image2._cmd_formatter)
+
+    def test_subclass_parameters(self):
+        class _QemuImg(qemu_storage.QemuImg):
+            qemu_img_parameters = dict(qemu_storage.QemuImg.qemu_img_parameters,
+                                       progress="-p")
+
+        image = _QemuImg(self.params, "/tmp", "image1")
+        template = "convert {progress!b} {image_filename}"
+        self.assertEqual(
+            image._cmd_formatter.vformat(template, (),
+                                         {"image_filename": "a.qcow2"}),
+            "convert a.qcow2")
+        self.assertEqual(
+            image._cmd_formatter.vformat(template, (),
+                                         {"progress": True,
+                                          "image_filename": "a.qcow2"}),
+            "convert -p a.qcow2")
+        self.assertIsNot(
+            image._cmd_formatter,
+            qemu_storage.QemuImg(self.params, "/tmp",
+                                 "image1")._cmd_formatter)
+
+    def test_added_parameter(self):
+        image = qemu_storage.QemuImg(self.params, "/tmp", "image1")
+        image.qemu_img_parameters = dict(image.qemu_img_parameters,
+                                         progress="-p")
+        self.assertEqual(
+            image._cmd_formatter.vformat("convert {progress!b} a.qcow2", (),
+                                         {}),
+            "convert a.qcow2")
+
+
+if __name__ == '__main__':
+    unittest.main()
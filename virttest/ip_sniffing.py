@@ -7,9 +7,9 @@ import logging
 import re
 
 try:
-    from collections import Iterable
-except ImportError:
     from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 
 import aexpect
 from aexpect.remote import handle_prompts
@@ -5,13 +5,17 @@ This exports:
   - two functions for get image/blkdebug filename
   - class for image operates and basic parameters
 """
-import collections
+import copy
+import errno
 import json
 import logging
 import os
 import re
-import six
+import stat
 import string
+import tempfile
+import threading
+import time
 
 from avocado.core import exceptions
 from avocado.utils import process
@@ -23,8 +27,54 @@ from virttest import nvme
 from virttest import data_dir
 from virttest import error_context
 
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
 LOG = logging.getLogger('avocado.' + __name__)
 
+# qemu-img help text, keyed by the qemu-img binary path
+_HELP_TEXT_CACHE = {}
+# sub-commands in the 'Command syntax' section of qemu-img help text
+_HELP_SUBCOMMAND_RE = re.compile(r'^  (\w[\w-]*)\s', re.M)
+# successful qemu-img measure results of images, keyed by the command and
+# the state of the image file, at most _MEASURE_CACHE_SIZE results are kept,
+# guarded by _MEASURE_CACHE_LOCK
+_MEASURE_CACHE = {}
+_MEASURE_CACHE_SIZE = 64
+_MEASURE_CACHE_LOCK = threading.Lock()
+# serializes the updates of the qemu-img check cache file
+_CHECK_CACHE_LOCK = threading.Lock()
+
+_ISCSI_FILENAME_RE = re.compile(
+    r'iscsi://((?P<user>.+?):(?P<password>.+?)@)?(?P<portal>.+)/(?P<target>.+?)/(?P<lun>\d+)')
+_RBD_FILENAME_RE = re.compile(
+    r'rbd:(?P<pool>.+?)/(?P<namespace>.+?(?=/))?/?(?P<image>[^:]+)'
+    r'(:conf=(?P<conf>.+))?'
+)
+_GLUSTER_FILENAME_RE = re.compile(
+    r'gluster\+?(?P<type>.+)?://((?P<host>[^/]+?)(:(?P<port>\d+))?)?/'
+    r'(?P<volume>.+?)/(?P<path>[^,?]+)'
+    r'(\?socket=(?P<socket>[^,]+))?'
+)
+_NBD_SCHEME_RE = re.compile(r'nbd(\+\w+)?://')
+_NBD_FILENAME_RE = re.compile(
+    r'nbd(\+(?:.+))?://((?P<host>[^/:?]+)(:(?P<port>\d+))?)?'
+    r'(/(?P<export>[^?]+))?'
+    r'(\?socket=(?P<socket>.+))?'
+)
+_SSH_FILENAME_RE = re.compile(
+    r'ssh://((?P<user>.+)@)?(?P<host>[^/:?]+)(:(?P<port>\d+))?'
+    r'(?P<path>/[^?]+)'
+    r'(\?host_key_check=(?P<host_key_check>.+))?'
+)
+_SSH_HOST_KEY_HASH_RE = re.compile(r'(?P<type>md5|sha1):(?P<hash>.+)')
+_CURL_SCHEME_RE = re.compile(r'(http|https|ftp|ftps)://')
+_CURL_FILENAME_RE = re.compile(
+    r'(?P<protocol>.+?)://((?P<user>.+?)(:(?P<password>.+?))?@)?'
+    r'(?P<server>.+?)/(?P<path>.+)')
+
 
 def filename_to_file_opts(filename):
     """Convert filename into file opts, used by both qemu-img and qemu-kvm"""
@@ -32,9 +82,7 @@ def filename_to_file_opts(filename):
     if not filename:
         file_opts = {}
     elif filename.startswith('iscsi:'):
-        filename_pattern = re.compile(
-            r'iscsi://((?P<user>.+?):(?P<password>.+?)@)?(?P<portal>.+)/(?P<target>.+?)/(?P<lun>\d+)')
-        matches = filename_pattern.match(filename)
+        matches = _ISCSI_FILENAME_RE.match(filename)
         if matches:
             if (matches.group('portal') is not None
                     and matches.group('target') is not None
@@ -49,11 +97,7 @@ def filename_to_file_opts(filename):
                     # optional option
                     file_opts['user'] = matches.group('user')
     elif filename.startswith('rbd:'):
-        filename_pattern = re.compile(
-            r'rbd:(?P<pool>.+?)/(?P<namespace>.+?(?=/))?/?(?P<image>[^:]+)'
-            r'(:conf=(?P<conf>.+))?'
-        )
-        matches = filename_pattern.match(filename)
+        matches = _RBD_FILENAME_RE.match(filename)
         if matches:
             if (matches.group('pool') is not None
                     and matches.group('image') is not None):
@@ -68,12 +112,7 @@ def filename_to_file_opts(filename):
                     # optional option
                     file_opts['namespace'] = matches.group('namespace')
     elif filename.startswith('gluster'):
-        filename_pattern = re.compile(
-            r'gluster\+?(?P<type>.+)?://((?P<host>[^/]+?)(:(?P<port>\d+))?)?/'
-            r'(?P<volume>.+?)/(?P<path>[^,?]+)'
-            r'(\?socket=(?P<socket>[^,]+))?'
-        )
-        matches = filename_pattern.match(filename)
+        matches = _GLUSTER_FILENAME_RE.match(filename)
         if matches:
             servers = []
             transport = 'inet' if not matches.group('type') or matches.group('type') == 'tcp' else matches.group('type')
@@ -99,14 +138,9 @@ def filename_to_file_opts(filename):
                              'path': matches.group('path')}
                 file_opts.update({'server.{i}.{k}'.format(i=i, k=k): v
                                   for i, server in enumerate(servers)
-                                  for k, v in six.iteritems(server)})
-    elif re.match(r'nbd(\+\w+)?://', filename):
-        filename_pattern = re.compile(
-            r'nbd(\+(?:.+))?://((?P<host>[^/:?]+)(:(?P<port>\d+))?)?'
-            r'(/(?P<export>[^?]+))?'
-            r'(\?socket=(?P<socket>.+))?'
-        )
-        matches = filename_pattern.match(filename)
+                                  for k, v in server.items()})
+    elif _NBD_SCHEME_RE.match(filename):
+        matches = _NBD_FILENAME_RE.match(filename)
         if matches:
             server = {}
             host = matches.group('host')
@@ -133,12 +167,7 @@ def filename_to_file_opts(filename):
         addr, namespace = nvme.parse_uri(filename)
         file_opts = {'driver': 'nvme', 'device': addr, 'namespace': int(namespace)}
     elif filename.startswith('ssh:'):
-        filename_pattern = re.compile(
-            r'ssh://((?P<user>.+)@)?(?P<host>[^/:?]+)(:(?P<port>\d+))?'
-            r'(?P<path>/[^?]+)'
-            r'(\?host_key_check=(?P<host_key_check>.+))?'
-        )
-        matches = filename_pattern.match(filename)
+        matches = _SSH_FILENAME_RE.match(filename)
         if matches:
             matches = matches.groupdict()
             if matches['host'] is not None and matches['path'] is not None:
@@ -160,18 +189,15 @@ def filename_to_file_opts(filename):
                     elif matches['host_key_check'] == 'yes':
                         file_opts['host-key-check.mode'] = 'known_hosts'
                     else:
-                        m = re.match(r'(?P<type>md5|sha1):(?P<hash>.+)',
-                                     matches['host_key_check']).groupdict()
+                        m = _SSH_HOST_KEY_HASH_RE.match(
+                            matches['host_key_check']).groupdict()
                         file_opts.update({
                             'host-key-check.mode': 'hash',
                             'host-key-check.type': m['type'],
                             'host-key-check.hash': m['hash']
                         })
-    elif re.match(r'(http|https|ftp|ftps)://', filename):
-        filename_pattern = re.compile(
-            r'(?P<protocol>.+?)://((?P<user>.+?)(:(?P<password>.+?))?@)?'
-            r'(?P<server>.+?)/(?P<path>.+)')
-        matches = filename_pattern.match(filename)
+    elif _CURL_SCHEME_RE.match(filename):
+        matches = _CURL_FILENAME_RE.match(filename)
         if matches:
             matches = matches.groupdict()
             if all((matches['protocol'], matches['server'], matches['path'])):
@@ -199,12 +225,17 @@ def filename_to_file_opts(filename):
     return file_opts
 
 
-def _get_image_meta(image, params, root_dir):
-    """Retrieve image meta dict."""
-    meta = collections.OrderedDict()
-    meta["file"] = collections.OrderedDict()
+def _get_image_meta(image, params, root_dir, filename=None):
+    """
+    Retrieve image meta dict.
 
-    filename = storage.get_image_filename(params, root_dir)
+    :param filename: image filename, generated from params if not given
+    """
+    meta = {}
+    meta["file"] = {}
+
+    if filename is None:
+        filename = storage.get_image_filename(params, root_dir)
     meta_file = filename_to_file_opts(filename)
     meta["file"].update(meta_file)
 
@@ -249,7 +280,7 @@ def _get_image_meta(image, params, root_dir):
                                   'port': '%s' % peer.get('port', '0')})
             meta['file'].update({'server.{i}.{k}'.format(i=i + 1, k=k): v
                                  for i, server in enumerate(peers)
-                                 for k, v in six.iteritems(server)})
+                                 for k, v in server.items()})
         elif auth_info.storage_type == 'nbd':
             # qemu-img, as a client, accesses nbd storage
             if auth_info.tls_creds:
@@ -267,15 +298,16 @@ def _get_image_meta(image, params, root_dir):
                 'timeout': (auth_info.timeout, auth_info.timeout)
             }
             meta['file'].update({
-                k: v[1] for k, v in six.iteritems(mapping) if v[0]
+                k: v[1] for k, v in mapping.items() if v[0]
             })
 
     return meta
 
 
-def get_image_json(image, params, root_dir):
+def get_image_json(image, params, root_dir, filename=None):
     """Generate image json representation."""
-    return "json:%s" % json.dumps(_get_image_meta(image, params, root_dir))
+    return "json:%s" % json.dumps(_get_image_meta(image, params, root_dir,
+                                                  filename))
 
 
 def get_image_opts(image, params, root_dir):
@@ -283,22 +315,16 @@ def get_image_opts(image, params, root_dir):
     def _dict_to_dot(dct):
         """Convert dictionary to dot representation."""
         flat = []
-        prefix = []
-        stack = [six.iteritems(dct)]
+        # items are pushed in reverse to keep the order of the dictionary
+        stack = [((), k, v) for k, v in reversed(list(dct.items()))]
         while stack:
-            it = stack[-1]
-            try:
-                key, value = next(it)
-            except StopIteration:
-                if prefix:
-                    prefix.pop()
-                stack.pop()
-                continue
-            if isinstance(value, collections.Mapping):
-                prefix.append(key)
-                stack.append(six.iteritems(value))
+            prefix, key, value = stack.pop()
+            if isinstance(value, dict):
+                prefix += (key,)
+                stack.extend((prefix, k, v)
+                             for k, v in reversed(list(value.items())))
             else:
-                flat.append((".".join(prefix + [key]), value))
+                flat.append((".".join(prefix + (key,)), value))
         return flat
 
     meta = _get_image_meta(image, params, root_dir)
@@ -306,12 +332,19 @@ def get_image_opts(image, params, root_dir):
                      attr, value in _dict_to_dot(meta)])
 
 
+def _get_image_filename(image, params, root_dir):
+    """Generate image filename representation."""
+    return storage.get_image_filename(params, root_dir)
+
+
+_IMAGE_REPR_MAPPING = {"filename": _get_image_filename,
+                       "json": get_image_json,
+                       "opts": get_image_opts}
+
+
 def get_image_repr(image, params, root_dir, representation=None):
     """Get image representation."""
-    mapping = {"filename": lambda i, p, r: storage.get_image_filename(p, r),
-               "json": get_image_json,
-               "opts": get_image_opts}
-    func = mapping.get(representation, None)
+    func = _IMAGE_REPR_MAPPING.get(representation, None)
     if func is None:
         image_secret = storage.ImageSecret.image_secret_define_by_params(
             image, params)
@@ -343,10 +376,56 @@ def get_image_repr(image, params, root_dir, representation=None):
                         auth_info.readahead, auth_info.timeout)):
                     access_needed = True
 
-        func = mapping["json"] if image_secret or access_needed else mapping["filename"]
+        key = "json" if image_secret or access_needed else "filename"
+        func = _IMAGE_REPR_MAPPING[key]
     return func(image, params, root_dir)
 
 
+def _get_image_file_key(qemu_img_binary, image_filename):
+    """
+    Get the key recording the state of a local image file and of the
+    qemu-img binary, None if the image is not a local regular file.
+    """
+    try:
+        binary_stat = os.stat(qemu_img_binary)
+        image_stat = os.stat(image_filename)
+    except OSError:
+        return None
+    # size and mtime of a block device do not change with its content
+    if not stat.S_ISREG(image_stat.st_mode):
+        return None
+    return "%s:%d:%d:%s:%d:%d:%d" % (
+        qemu_img_binary, binary_stat.st_ino, binary_stat.st_mtime_ns,
+        os.path.abspath(image_filename),
+        image_stat.st_ino, image_stat.st_size, image_stat.st_mtime_ns)
+
+
+def _load_check_cache(cache_file):
+    """Load the cache of images passing qemu-img check."""
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_check_cache(cache_file, image_filename, key):
+    """Record an image passing qemu-img check into the cache."""
+    # images may be checked by parallel threads, serialize the updates and
+    # replace the file at once so that readers never see a partial file
+    with _CHECK_CACHE_LOCK:
+        checked = _load_check_cache(cache_file)
+        checked[image_filename] = key
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        try:
+            with os.fdopen(fd, "w") as cache:
+                json.dump(checked, cache)
+            os.replace(tmp_file, cache_file)
+        except Exception:
+            os.unlink(tmp_file)
+            raise
+
+
 class _ParameterAssembler(string.Formatter):
     """
     Command line parameter assembler.
@@ -359,39 +438,80 @@ class _ParameterAssembler(string.Formatter):
     def __init__(self, cmd_params=None):
         string.Formatter.__init__(self)
         self.cmd_params = cmd_params or {}
+        self._templates = {}
+
+    def _compile(self, format_string):
+        """
+        Split format string into words, each word is a list of literal
+        strings and (field_name, parameter, conversion, format_spec) tuples,
+        parameter is sentinal if field_name is not a command line parameter.
+        """
+        words = []
+        parts = []
+        auto_index = 0
+        for literal, field_name, format_spec, conversion in \
+                self.parse(format_string):
+            chunks = literal.split(" ")
+            if chunks[0]:
+                parts.append(chunks[0])
+            for chunk in chunks[1:]:
+                if parts:
+                    words.append(parts)
+                parts = [chunk] if chunk else []
+            if field_name is not None:
+                if field_name == "":
+                    # automatic field numbering, i.e. '{}'
+                    field_name = str(auto_index)
+                    auto_index += 1
+                parameter = self.cmd_params.get(field_name, self.sentinal)
+                parts.append((field_name, parameter, conversion, format_spec))
+        if parts:
+            words.append(parts)
+        return words
+
+    def vformat(self, format_string, args, kwargs):
+        """Format string and drop the words rendered as empty."""
+        words = self._templates.get(format_string)
+        if words is None:
+            words = self._templates[format_string] = self._compile(
+                format_string)
+
+        cmd = []
+        for parts in words:
+            word = []
+            for part in parts:
+                if isinstance(part, tuple):
+                    field_name, parameter, conversion, format_spec = part
+                    if parameter is self.sentinal:
+                        value = self.convert_field(
+                            self.get_field(field_name, args, kwargs)[0],
+                            conversion)
+                    else:
+                        value = self.convert_parameter(
+                            parameter, kwargs.get(field_name), conversion)
+                    part = self.format_field(value, format_spec)
+                word.append(part)
+            word = "".join(word).strip()
+            if word:
+                cmd.append(word)
+        return " ".join(cmd)
 
-    def format(self, format_string, *args, **kwargs):
-        """Remove redundant whitespaces and return format string."""
-        ret = string.Formatter.format(self, format_string, *args, **kwargs)
-        return re.sub(" +", " ", ret)
-
-    def get_value(self, key, args, kwargs):
-        try:
-            val = string.Formatter.get_value(self, key, args, kwargs)
-        except KeyError:
-            if key in self.cmd_params:
-                val = None
-            else:
-                raise
-        return (self.cmd_params.get(key, self.sentinal), val)
-
-    def convert_field(self, value, conversion):
+    @staticmethod
+    def convert_parameter(parameter, value, conversion):
         """
-        Do conversion on the resulting object.
+        Do conversion on the parameter and its value.
 
         supported conversions:
             'b': keep the parameter only if bool(value) is True.
             'v': keep both the parameter and its corresponding value,
                  the default mode.
         """
-        if value[0] is self.sentinal:
-            return string.Formatter.convert_field(self, value[1], conversion)
         if conversion is None:
             conversion = "v"
         if conversion == "v":
-            return "" if value[1] is None else " ".join(value)
+            return "" if value is None else "%s %s" % (parameter, value)
         if conversion == "b":
-            return value[0] if bool(value[1]) else ""
+            return parameter if bool(value) else ""
         raise ValueError("Unknown conversion specifier {}".format(conversion))
 
 
@@ -412,6 +532,7 @@ class QemuImg(storage.QemuImg):
         "resize_preallocation": "--preallocation",
         "resize_shrink": "--shrink",
         "convert_compressed": "-c",
+        "skip_target_image_creation": "-n",
         "cache_mode": "-t",
         "source_cache_mode": "-T",
         "target_image_format": "-O",
@@ -419,6 +540,8 @@ class QemuImg(storage.QemuImg):
         "rate_limit": "-r",
         "convert_target_is_zero": "--target-is-zero",
         "convert_backing_file": "-B",
+        "convert_coroutines": "-m",
+        "convert_unordered": "-W",
         "commit_drop": "-d",
         "compare_strict_mode": "-s",
         "compare_second_image_format": "-F"
@@ -431,18 +554,20 @@ class QemuImg(storage.QemuImg):
                  "{output_format} {check_repair} {force_share!b} "
                  "{image_filename}")
     convert_cmd = ("convert {secret_object} {tls_creds_object} "
-                   "{convert_compressed!b} {skip_target_image_creation} "
+                   "{convert_compressed!b} {skip_target_image_creation!b} "
                    "{image_format} {cache_mode} {source_cache_mode} "
                    "{target_image_format} {options} {convert_sparse_size} "
                    "{rate_limit} {convert_target_is_zero!b} "
-                   "{convert_backing_file} "
+                   "{convert_backing_file} {convert_coroutines} "
+                   "{convert_unordered!b} "
                    "{image_filename} {target_image_filename} "
                    "{target_image_opts}")
     commit_cmd = ("commit {secret_object} {image_format} {cache_mode} "
                   "{backing_file} {commit_drop!b} {image_filename} "
                   "{rate_limit}")
-    resize_cmd = ("resize {secret_object} {image_opts} {resize_shrink!b} "
-                  "{resize_preallocation} {image_filename} {image_size}")
+    resize_cmd = ("resize {secret_object} {image_opts} {image_format} "
+                  "{resize_shrink!b} {resize_preallocation} {image_filename} "
+                  "{image_size}")
     rebase_cmd = ("rebase {secret_object} {image_format} {cache_mode} "
                   "{source_cache_mode} {unsafe!b} {backing_file} "
                   "{backing_format} {image_filename}")
@@ -463,28 +588,90 @@ class QemuImg(storage.QemuImg):
         :param tag: Image tag defined in parameter images
         """
         storage.QemuImg.__init__(self, params, root_dir, tag)
-        self.image_cmd = utils_misc.get_qemu_img_binary(params)
-        q_result = process.run(self.image_cmd + ' -h', ignore_status=True,
-                               shell=True, verbose=False)
-        self.help_text = q_result.stdout_text
-        self.cap_force_share = '-U' in self.help_text
-        self._cmd_formatter = _ParameterAssembler(self.qemu_img_parameters)
+        self._qemu_img_binary = utils_misc.get_qemu_img_binary(params)
+        self.image_cmd = self._qemu_img_binary
+        # cap the address space/cpu time of every qemu-img run, e.g.
+        # qemu_img_limit_as = 1073741824 (bytes), qemu_img_limit_cpu = 30
+        limits = ["--%s=%s" % (resource, params[key])
+                  for resource, key in (("as", "qemu_img_limit_as"),
+                                        ("cpu", "qemu_img_limit_cpu"))
+                  if params.get(key)]
+        if limits:
+            self.image_cmd = "prlimit %s %s" % (" ".join(limits),
+                                                self.image_cmd)
+        self._help_text = None
+        self._supported_cmds_cache = None
+        self._image_json_cache = None
+        self._secret_objects_cache = (None, [])
 
-    def _parse_options(self, params):
-        """Build options used for qemu-img amend, create, convert, measure."""
+    @property
+    def _cmd_formatter(self):
+        """
+        Command assembler of qemu_img_parameters, shared by all objects of
+        the class unless the object overrides qemu_img_parameters.
+        """
+        qemu_img_parameters = self.qemu_img_parameters
+        owner = self if "qemu_img_parameters" in vars(self) else type(self)
+        formatter = vars(owner).get("_cmd_formatter_cache")
+        # rebuild it once the parameters change, not to treat a newly
+        # added parameter as a plain field
+        if formatter is None or formatter.cmd_params != qemu_img_parameters:
+            formatter = _ParameterAssembler(dict(qemu_img_parameters))
+            setattr(owner, "_cmd_formatter_cache", formatter)
+        return formatter
+
+    @property
+    def help_text(self):
+        """Help text of qemu-img, probed on first access."""
+        if self._help_text is None:
+            help_text = _HELP_TEXT_CACHE.get(self.image_cmd)
+            if help_text is None:
+                q_result = process.run(self.image_cmd + ' -h',
+                                       ignore_status=True, verbose=False)
+                help_text = q_result.stdout_text
+                # do not pin the help text of a failed probe
+                if q_result.exit_status == 0:
+                    _HELP_TEXT_CACHE[self.image_cmd] = help_text
+            self._help_text = help_text
+        return self._help_text
+
+    @property
+    def cap_force_share(self):
+        """Whether qemu-img supports the force share option(-U)."""
+        return '-U' in self.help_text
+
+    @property
+    def _supported_cmds(self):
+        """Sub-commands listed in the help text of qemu-img."""
+        if self._supported_cmds_cache is None:
+            self._supported_cmds_cache = frozenset(
+                _HELP_SUBCOMMAND_RE.findall(self.help_text))
+        return self._supported_cmds_cache
+
+    @property
+    def _image_json(self):
+        """json representation of the image, built once per image object."""
+        if self._image_json_cache is None:
+            self._image_json_cache = get_image_json(self.tag, self.params,
+                                                    self.root_dir,
+                                                    self.image_filename)
+        return self._image_json_cache
+
+    def _iter_options(self, params):
+        """Generate options used for qemu-img create, convert."""
         options_mapping = {
             "preallocated": (None, "preallocation", ("qcow2", "raw", "luks")),
             "image_cluster_size": (None, "cluster_size", ("qcow2",)),
+            "image_extended_l2": (None, "extended_l2", ("qcow2",)),
             "lazy_refcounts": (None, "lazy_refcounts", ("qcow2",)),
             "qcow2_compatible": (None, "compat", ("qcow2",))
         }
         image_format = params.get("image_format", "qcow2")
-        options = []
         for key, (default, opt_key, support_fmt) in options_mapping.items():
             if image_format in support_fmt:
                 value = params.get(key, default)
                 if value is not None:
-                    options.append("%s=%s" % (opt_key, value))
+                    yield "%s=%s" % (opt_key, value)
 
         if self.encryption_config.key_secret:
             opts = list(self.encryption_config)
@@ -496,33 +683,34 @@ class QemuImg(storage.QemuImg):
                 if opt_val:
                     if image_format == "qcow2":
                         opt_key = "encrypt.%s" % opt_key
-                    options.append("%s=%s" % (opt_key.replace("_", "-"),
-                                              str(opt_val)))
+                    yield "%s=%s" % (opt_key.replace("_", "-"), opt_val)
 
         if self.data_file:
-            options.extend(
-                ("data_file=%s" % self.data_file.image_filename,
-                 "data_file_raw=%s" % params.get("image_data_file_raw", "off")))
+            yield "data_file=%s" % self.data_file.image_filename
+            yield "data_file_raw=%s" % params.get("image_data_file_raw", "off")
 
         for access_secret, secret_type in self._image_access_secret:
             if secret_type == 'password':
-                options.append("password-secret=%s" % access_secret.aid)
+                yield "password-secret=%s" % access_secret.aid
             elif secret_type == 'key':
-                options.append("key-secret=%s" % access_secret.aid)
+                yield "key-secret=%s" % access_secret.aid
             elif secret_type == 'cookie':
-                options.append("cookie-secret=%s" % access_secret.aid)
+                yield "cookie-secret=%s" % access_secret.aid
 
         image_extra_params = params.get("image_extra_params")
         if image_extra_params:
-            options.append(image_extra_params.strip(','))
+            yield image_extra_params.strip(',')
         if params.get("has_backing_file") == "yes":
             backing_param = params.object_params("backing_file")
             backing_file = storage.get_image_filename(backing_param,
                                                       self.root_dir)
-            options.append("backing_file=%s" % backing_file)
+            yield "backing_file=%s" % backing_file
             backing_fmt = backing_param.get("image_format")
-            options.append("backing_fmt=%s" % backing_fmt)
-        return options
+            yield "backing_fmt=%s" % backing_fmt
+
+    def _parse_options(self, params):
+        """Build the '-o' option string for qemu-img create, convert."""
+        return ",".join(self._iter_options(params))
 
     def _need_auth_info(self, image=None):
         """
@@ -626,9 +814,15 @@ class QemuImg(storage.QemuImg):
     @property
     def _secret_objects(self):
         """All secret objects str needed for command line."""
-        secret_objects = self.encryption_config.image_key_secrets
-        secret_obj_str = "--object secret,id={s.aid},data={s.data}"
-        return [secret_obj_str.format(s=s) for s in secret_objects]
+        config, secret_objects = self._secret_objects_cache
+        if config is not self.encryption_config:
+            config = self.encryption_config
+            secret_obj_str = "--object secret,id={s.aid},data={s.data}"
+            secret_objects = [secret_obj_str.format(s=s)
+                              for s in config.image_key_secrets]
+            self._secret_objects_cache = (config, secret_objects)
+        # return a copy, callers append their own objects to it
+        return list(secret_objects)
 
     @property
     def _image_access_tls_creds_object(self):
@@ -695,6 +889,10 @@ class QemuImg(storage.QemuImg):
                    format of the image (qcow2, raw etc)
                image_cluster_size (optional)
                    cluster size for the image
+               image_extended_l2 (optional)
+                   use extended L2 entries (subclusters), allowed values:
+                   on and off, usually set along with image_cluster_size
+                   128k; needs qemu-img 5.2 or later
                image_size
                    requested size of the image (a string qemu-img can
                    understand, such as '10G')
@@ -728,8 +926,9 @@ class QemuImg(storage.QemuImg):
             qemu_img_cmd = ("dd if=/dev/zero of=%s count=%s bs=%sK"
                             % (self.image_filename, size, block_size))
         else:
-            cmd_dict = {}
-            cmd_dict["image_format"] = self.image_format
+            cmd_dict = {"image_format": self.image_format,
+                        "image_filename": self.image_filename,
+                        "image_size": self.size}
             if self.base_tag:
                 # if base image has secret, use json representation
                 base_key_secrets = self.encryption_config.base_key_secrets
@@ -766,13 +965,11 @@ class QemuImg(storage.QemuImg):
             if tls_creds_objects:
                 cmd_dict["tls_creds_object"] = " ".join(tls_creds_objects)
 
-            cmd_dict["image_filename"] = self.image_filename
-            cmd_dict["image_size"] = self.size
             options = self._parse_options(params)
             if options:
-                cmd_dict["options"] = ",".join(options)
+                cmd_dict["options"] = options
             qemu_img_cmd = self.image_cmd + " " + \
-                self._cmd_formatter.format(self.create_cmd, **cmd_dict)
+                self._cmd_formatter.vformat(self.create_cmd, (), cmd_dict)
 
         if (params.get("image_backend", "filesystem") == "filesystem"):
             image_dirname = os.path.dirname(self.image_filename)
@@ -796,7 +993,7 @@ class QemuImg(storage.QemuImg):
         msg = "Create image by command: %s" % qemu_img_cmd
         error_context.context(msg, LOG.info)
         cmd_result = process.run(
-            qemu_img_cmd, shell=True, verbose=False, ignore_status=True)
+            qemu_img_cmd, verbose=False, ignore_status=True)
         if cmd_result.exit_status != 0 and not ignore_errors:
             raise exceptions.TestError("Failed to create image %s\n%s" %
                                        (self.image_filename, cmd_result))
@@ -837,6 +1034,14 @@ class QemuImg(storage.QemuImg):
                 zeros for all reads
             convert_backing_file
                 indicate that setting backing file to target image
+            convert_coroutines
+                the number of coroutines qemu-img uses for the conversion
+            convert_unordered
+                allow out-of-order writes to the target image
+            image_direct_io
+                yes to use cache mode none (O_DIRECT) for both images when
+                cache_mode/source_cache_mode are not given, the filesystem
+                must support O_DIRECT (tmpfs doesn't)
         """
         convert_target = params["convert_target"]
         convert_params = params.object_params(convert_target)
@@ -848,6 +1053,11 @@ class QemuImg(storage.QemuImg):
         convert_target_is_zero = convert_params.get_boolean(
                 "convert_target_is_zero")
         convert_backing_file = convert_params.get("convert_backing_file")
+        convert_coroutines = convert_params.get("convert_coroutines")
+        convert_unordered = convert_params.get_boolean("convert_unordered")
+        if params.get("image_direct_io") == "yes":
+            cache_mode = cache_mode or "none"
+            source_cache_mode = source_cache_mode or "none"
 
         cmd_dict = {
             "convert_compressed": convert_compressed == "yes",
@@ -859,15 +1069,17 @@ class QemuImg(storage.QemuImg):
             "target_image_filename": convert_image.image_filename,
             "cache_mode": cache_mode,
             "source_cache_mode": source_cache_mode,
-            "skip_target_image_creation": "-n" if skip_target_creation else "",
+            "skip_target_image_creation": skip_target_creation,
             "convert_target_is_zero": convert_target_is_zero,
             "convert_backing_file": convert_backing_file,
+            "convert_coroutines": convert_coroutines,
+            "convert_unordered": convert_unordered,
             "target_image_opts": ""
         }
 
         options = convert_image._parse_options(convert_params)
         if options:
-            cmd_dict["options"] = ",".join(options)
+            cmd_dict["options"] = options
 
         if skip_target_creation:
             # -o has no effect when skipping image creation
@@ -885,8 +1097,7 @@ class QemuImg(storage.QemuImg):
 
         if (self.encryption_config.key_secret
                 or self._need_auth_info(self.tag)):
-            cmd_dict["image_filename"] = "'%s'" % get_image_json(
-                self.tag, self.params, self.root_dir)
+            cmd_dict["image_filename"] = "'%s'" % self._image_json
             cmd_dict.pop("image_format")
 
         # source images secrets(luks)
@@ -928,7 +1139,7 @@ class QemuImg(storage.QemuImg):
             cmd_dict["tls_creds_object"] = " ".join(tls_creds_objects)
 
         convert_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.convert_cmd, **cmd_dict)
+            self._cmd_formatter.vformat(self.convert_cmd, (), cmd_dict)
 
         LOG.info("Convert image %s from %s to %s", self.image_filename,
                  self.image_format, convert_image.image_format)
@@ -960,8 +1171,7 @@ class QemuImg(storage.QemuImg):
         if secret_objects:
             cmd_dict["secret_object"] = " ".join(secret_objects)
         if self.encryption_config.key_secret:
-            cmd_dict["image_filename"] = "'%s'" % get_image_json(
-                self.tag, self.params, self.root_dir)
+            cmd_dict["image_filename"] = "'%s'" % self._image_json
             cmd_dict.pop("image_format")
         if self.base_tag:
             if self.base_tag == "null":
@@ -972,8 +1182,7 @@ class QemuImg(storage.QemuImg):
                 self.base_image_filename = base_image.image_filename
                 self.base_format = base_image.image_format
                 if base_image.encryption_config.key_secret:
-                    cmd_dict["backing_file"] = "'%s'" % get_image_json(
-                        base_image.tag, base_image.params, base_image.root_dir)
+                    cmd_dict["backing_file"] = "'%s'" % base_image._image_json
                 else:
                     cmd_dict["backing_file"] = base_image.image_filename
                 cmd_dict["backing_format"] = base_image.image_format
@@ -984,7 +1193,7 @@ class QemuImg(storage.QemuImg):
         LOG.info("Rebase snapshot %s to %s..." % (self.image_filename,
                                                   self.base_image_filename))
         rebase_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.rebase_cmd, **cmd_dict)
+            self._cmd_formatter.vformat(self.rebase_cmd, (), cmd_dict)
         process.run(rebase_cmd)
 
         return self.base_tag
@@ -1012,16 +1221,14 @@ class QemuImg(storage.QemuImg):
             base_params = self.params.object_params(base)
             base_image = QemuImg(base_params, self.root_dir, base)
             if base_image.encryption_config.key_secret:
-                cmd_dict["backing_file"] = "'%s'" % get_image_json(
-                    base, base_params, self.root_dir)
+                cmd_dict["backing_file"] = "'%s'" % base_image._image_json
             else:
                 cmd_dict["backing_file"] = base_image.image_filename
         if self.encryption_config.key_secret:
-            cmd_dict["image_filename"] = "'%s'" % get_image_json(
-                self.tag, self.params, self.root_dir)
+            cmd_dict["image_filename"] = "'%s'" % self._image_json
             cmd_dict.pop("image_format")
         commit_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.commit_cmd, **cmd_dict)
+            self._cmd_formatter.vformat(self.commit_cmd, (), cmd_dict)
         LOG.info("Commit image %s" % self.image_filename)
         process.run(commit_cmd)
 
@@ -1128,8 +1335,11 @@ class QemuImg(storage.QemuImg):
                     secret_files.append(auth.filename)
 
         for f in secret_files:
-            if os.path.exists(f):
+            try:
                 os.unlink(f)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
 
     def info(self, force_share=False, output="human"):
         """
@@ -1171,8 +1381,7 @@ class QemuImg(storage.QemuImg):
         image_filename = self.image_filename
         if self._need_auth_info(self.tag):
             # use json repr when access info is required
-            image_filename = "'%s'" % get_image_json(self.tag, self.params,
-                                                     self.root_dir)
+            image_filename = "'%s'" % self._image_json
         if os.path.exists(image_filename) or self.is_remote_image():
             cmd += " %s --output=%s" % (image_filename, output)
             output = process.run(cmd, verbose=True).stdout_text
@@ -1187,7 +1396,8 @@ class QemuImg(storage.QemuImg):
         """
         image_info = self.info()
         if image_info:
-            image_format = re.findall("file format: (\w+)", image_info)[0]
+            image_format = image_info.partition("file format: ")[2].split(
+                None, 1)[0]
         else:
             image_format = None
         return image_format
@@ -1200,6 +1410,9 @@ class QemuImg(storage.QemuImg):
         """
         supports_cmd = True
 
+        if cmd in self._supported_cmds:
+            return supports_cmd
+        # not a sub-command, look it up in the whole help text
         if cmd not in self.help_text:
             LOG.error("%s does not support command '%s'", self.image_cmd, cmd)
             supports_cmd = False
@@ -1226,14 +1439,15 @@ class QemuImg(storage.QemuImg):
             return None
         else:
             LOG.info("Comparing images %s and %s", image1, image2)
-            compare_cmd = "%s compare" % self.image_cmd
-            if force_share:
-                compare_cmd += " -U"
-            if strict_mode:
-                compare_cmd += " -s"
-            compare_cmd += " %s %s" % (image1, image2)
-            cmd_result = process.run(compare_cmd, ignore_status=True,
-                                     shell=True)
+            cmd_dict = {
+                "compare_strict_mode": strict_mode,
+                "force_share": force_share,
+                "image_filename": image1,
+                "compare_second_image_filename": image2,
+            }
+            compare_cmd = self.image_cmd + " " + \
+                self._cmd_formatter.vformat(self.compare_cmd, (), cmd_dict)
+            cmd_result = process.run(compare_cmd, ignore_status=True)
 
             if verbose:
                 LOG.debug("Output from command: %s", cmd_result.stdout_text)
@@ -1320,18 +1534,16 @@ class QemuImg(storage.QemuImg):
 
         if (self.encryption_config.key_secret
                 or self._need_auth_info(self.tag)):
-            cmd_dict["image_filename"] = "'%s'" % \
-                get_image_json(self.tag, self.params, self.root_dir)
+            cmd_dict["image_filename"] = "'%s'" % self._image_json
 
         if (target_image.encryption_config.key_secret
                 or target_image._need_auth_info(target_image.tag)):
             cmd_dict["compare_second_image_filename"] = "'%s'" % \
-                get_image_json(target_image.tag, target_image.params,
-                               target_image.root_dir)
+                target_image._image_json
 
         compare_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.compare_cmd, **cmd_dict)
-        result = process.run(compare_cmd, ignore_status=True, shell=True)
+            self._cmd_formatter.vformat(self.compare_cmd, (), cmd_dict)
+        result = process.run(compare_cmd, ignore_status=True)
 
         if verbose:
             LOG.debug("compare output:\n%s", result.stdout_text)
@@ -1361,8 +1573,11 @@ class QemuImg(storage.QemuImg):
                     "output_format": output}
         if (self.encryption_config.key_secret
                 or self._need_auth_info(self.tag)):
-            cmd_dict["image_filename"] = "'%s'" % get_image_json(
-                self.tag, params, root_dir)
+            if params is self.params and root_dir == self.root_dir:
+                image_json = self._image_json
+            else:
+                image_json = get_image_json(self.tag, params, root_dir)
+            cmd_dict["image_filename"] = "'%s'" % image_json
 
         # access secret objects of the backing images
         secret_objects = self._backing_access_secret_objects
@@ -1389,10 +1604,10 @@ class QemuImg(storage.QemuImg):
         if tls_creds_objects:
             cmd_dict["tls_creds_object"] = " ".join(tls_creds_objects)
 
-        check_cmd = self.image_cmd + " " + self._cmd_formatter.format(
-            self.check_cmd, **cmd_dict)
+        check_cmd = self.image_cmd + " " + self._cmd_formatter.vformat(
+            self.check_cmd, (), cmd_dict)
         cmd_result = process.run(check_cmd, ignore_status=True,
-                                 shell=True, verbose=False)
+                                 verbose=False)
 
         return cmd_result
 
@@ -1406,31 +1621,56 @@ class QemuImg(storage.QemuImg):
         :note: params should contain:
                image_name -- the name of the image file, without extension
                image_format -- the format of the image (qcow2, raw etc)
+               image_check_cache -- (optional) yes to skip the check of a
+                                    local image unchanged since it last
+                                    passed the check with the same qemu-img
+                                    binary, the results are kept in the
+                                    tmp dir, which may outlive the job
 
         :raise VMImageCheckError: In case qemu-img check fails on the image.
         """
+        def _log_check_output(cmd_result):
+            """Log the output of qemu-img check in one record."""
+            lines = ["[stdout] %s" % line
+                     for line in cmd_result.stdout_text.splitlines()]
+            lines.extend("[stderr] %s" % line
+                         for line in cmd_result.stderr_text.splitlines())
+            if lines:
+                LOG.error("%s", "\n".join(lines))
+
         image_filename = self.image_filename
         LOG.debug("Checking image file %s", image_filename)
         image_is_checkable = self.image_format in ['qcow2', 'qed']
         force_share &= self.cap_force_share
-
-        if (storage.file_exists(params, image_filename) or
-                self.is_remote_image()) and image_is_checkable:
+        # the existence probe may be a remote call (gluster, ceph, ssh...)
+        image_exists = storage.file_exists(params, image_filename)
+
+        if (image_exists or self.is_remote_image()) and image_is_checkable:
+            check_cache_key = None
+            if params.get("image_check_cache") == "yes":
+                check_cache_file = os.path.join(data_dir.get_tmp_dir(),
+                                                "qemu_img_check_cache.json")
+                check_cache_key = _get_image_file_key(self._qemu_img_binary,
+                                                      image_filename)
+                checked = _load_check_cache(check_cache_file)
+                if (check_cache_key is not None and
+                        checked.get(image_filename) == check_cache_key):
+                    LOG.debug("Image file %s unchanged since its last "
+                              "check, skipping check", image_filename)
+                    return
             try:
                 # FIXME: do we really need it?
                 self.info(force_share)
             except process.CmdError:
                 LOG.error("Error getting info from image %s", image_filename)
             cmd_result = self.check(params, root_dir, force_share)
+            if cmd_result.exit_status == 0 and check_cache_key is not None:
+                _save_check_cache(check_cache_file, image_filename,
+                                  check_cache_key)
             # Error check, large chances of a non-fatal problem.
             # There are chances that bad data was skipped though
             if cmd_result.exit_status == 1:
-                stdout = cmd_result.stdout_text
-                for e_line in stdout.splitlines():
-                    LOG.error("[stdout] %s", e_line)
-                stderr = cmd_result.stderr_text
-                for e_line in stderr.splitlines():
-                    LOG.error("[stderr] %s", e_line)
+                _log_check_output(cmd_result)
                 chk = params.get("backup_image_on_check_error", "no")
                 if chk == "yes":
                     self.backup_image(params, root_dir, "backup", False)
@@ -1441,12 +1681,7 @@ class QemuImg(storage.QemuImg):
             # Exit status 2 is data corruption for sure,
             # so fail the test
             elif cmd_result.exit_status == 2:
-                stdout = cmd_result.stdout_text
-                for e_line in stdout.splitlines():
-                    LOG.error("[stdout] %s", e_line)
-                stderr = cmd_result.stderr_text
-                for e_line in stderr.splitlines():
-                    LOG.error("[stderr] %s", e_line)
+                _log_check_output(cmd_result)
                 chk = params.get("backup_image_on_check_error", "no")
                 if chk == "yes":
                     self.backup_image(params, root_dir, "backup", False)
@@ -1459,7 +1694,7 @@ class QemuImg(storage.QemuImg):
                                           "integrity problem was found "
                                           "though. (%s)" % image_filename)
         else:
-            if not storage.file_exists(params, image_filename):
+            if not image_exists:
                 LOG.debug("Image file %s not found, skipping check",
                           image_filename)
             elif not image_is_checkable:
@@ -1516,6 +1751,9 @@ class QemuImg(storage.QemuImg):
                    used for erasing an existing password
                amend_extra_params
                    additional options, used for extending amend
+               image_direct_io
+                   yes to use cache mode none (O_DIRECT) when cache_mode is
+                   not given
 
         :return: process.CmdResult object containing the result of the
                 command
@@ -1528,22 +1766,24 @@ class QemuImg(storage.QemuImg):
             sec_data = params["amend_secret_data"]
             secret_obj_str = "--object secret,id=%s,data=%s" % (sec_id, sec_data)
             secret_objects.append(secret_obj_str)
-            cmd_list.append(" ".join(secret_objects))
-        options = []
-        for key, val in six.iteritems(params):
-            if key.startswith('amend_') and \
-                    key not in ["amend_secret_id", "amend_secret_data"]:
-                options.append("%s=%s" % (key[6:], val))
+            cmd_list.extend(secret_objects)
+        options = ["%s=%s" % (key[6:], val) for key, val in params.items()
+                   if key.startswith('amend_') and key not in
+                   ("amend_secret_id", "amend_secret_data",
+                    "amend_extra_params")]
+        extra_params = params.get("amend_extra_params")
+        if extra_params:
+            options.append(extra_params)
+        if params.get("image_direct_io") == "yes":
+            cache_mode = cache_mode or "none"
         if cache_mode:
-            cmd_list.append("-t %s" % cache_mode)
+            cmd_list.extend(["-t", cache_mode])
         if options:
-            cmd_list.append("-o %s" %
-                            ",".join(options).replace("extra_params=", ""))
+            cmd_list.extend(["-o", ",".join(options)])
         if self.encryption_config.key_secret:
-            cmd_list.append("'%s'" % get_image_json(self.tag,
-                                                    self.params, self.root_dir))
+            cmd_list.append("'%s'" % self._image_json)
         else:
-            cmd_list.append("-f %s %s" % (self.image_format, self.image_filename))
+            cmd_list.extend(["-f", self.image_format, self.image_filename])
         LOG.info("Amend image %s" % self.image_filename)
         cmd_result = process.run(" ".join(cmd_list), ignore_status=ignore_status)
         return cmd_result
@@ -1561,17 +1801,18 @@ class QemuImg(storage.QemuImg):
         cmd_dict = {
             "resize_shrink": shrink,
             "resize_preallocation": preallocation,
+            "image_format": self.image_format,
             "image_filename": self.image_filename,
             "image_size": size,
         }
         if self.encryption_config.key_secret:
-            cmd_dict["image_filename"] = "'%s'" % get_image_json(
-                self.tag, self.params, self.root_dir)
+            cmd_dict["image_filename"] = "'%s'" % self._image_json
+            cmd_dict.pop("image_format")
         secret_objects = self._secret_objects
         if secret_objects:
             cmd_dict["secret_object"] = " ".join(secret_objects)
         resize_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.resize_cmd, **cmd_dict)
+            self._cmd_formatter.vformat(self.resize_cmd, (), cmd_dict)
         cmd_result = process.run(resize_cmd, ignore_status=True)
         return cmd_result
 
@@ -1583,8 +1824,8 @@ class QemuImg(storage.QemuImg):
         :return: process.CmdResult object containing the result of the
                  command
         """
-        cmd_list = [self.image_cmd, "map",
-                    ("--output=%s" % output), self.image_filename]
+        cmd_list = [self.image_cmd, "map", "--output=%s" % output,
+                    "-f", self.image_format, self.image_filename]
         cmd_result = process.run(" ".join(cmd_list), ignore_status=True)
         return cmd_result
 
@@ -1599,9 +1840,13 @@ class QemuImg(storage.QemuImg):
                        (`human`, `json`)
         :return: process.CmdResult object containing the result of the
                  command
+
+        :note: with param image_measure_cache = yes, measuring a local image
+               without backing image or external data file again returns the
+               previous result while the image file is unchanged
         """
-        cmd_list = [self.image_cmd, "measure", ("--output=%s" % output),
-                    ("-O %s" % target_fmt)]
+        cmd_list = [self.image_cmd, "measure", "--output=%s" % output,
+                    "-O", target_fmt]
 
         if target_fmt == "luks":
             target_image = self.params.get("image_measure_target", "tgt")
@@ -1613,23 +1858,43 @@ class QemuImg(storage.QemuImg):
             target_image_object = QemuImg(
                 target_image_params, self.root_dir, target_image)
             cmd_list.append(target_image_object._secret_objects[-1])
-            cmd_list.append('-o key-secret=%s' %
-                            target_image_object.encryption_config.key_secret.aid)
+            key_secret = target_image_object.encryption_config.key_secret
+            cmd_list.extend(["-o", "key-secret=%s" % key_secret.aid])
 
+        image_file_key = None
         if size:
-            cmd_list.append(("--size %s" % size))
+            cmd_list.extend(["--size", str(size)])
         else:
+            # measure walks the backing chain, whose changes can not be told
+            # from the image file itself
+            if (self.params.get("image_measure_cache") == "yes" and
+                    not self.base_tag and not self.data_file and
+                    self.params.get("has_backing_file") != "yes"):
+                image_file_key = _get_image_file_key(
+                    self._qemu_img_binary, self.image_filename)
             if self.encryption_config.key_secret:
                 cmd_list.append(self._secret_objects[-1])
-                image_json_str = get_image_json(self.tag,
-                                                self.params,
-                                                self.root_dir)
-                cmd_list.append("'%s'" % image_json_str)
+                cmd_list.append("'%s'" % self._image_json)
             else:
-                cmd_list.extend([("-f %s" % self.image_format),
+                cmd_list.extend(["-f", self.image_format,
                                  self.image_filename])
 
-        cmd_result = process.run(" ".join(cmd_list), ignore_status=True)
+        measure_cmd = " ".join(cmd_list)
+        # measuring an unchanged image again gives the same result
+        cache_key = (measure_cmd, image_file_key)
+        if image_file_key is not None:
+            # images may be measured by parallel threads
+            with _MEASURE_CACHE_LOCK:
+                cmd_result = _MEASURE_CACHE.get(cache_key)
+            if cmd_result is not None:
+                return copy.copy(cmd_result)
+        cmd_result = process.run(measure_cmd, ignore_status=True)
+        if image_file_key is not None and cmd_result.exit_status == 0:
+            with _MEASURE_CACHE_LOCK:
+                if len(_MEASURE_CACHE) >= _MEASURE_CACHE_SIZE:
+                    # drop the oldest result
+                    del _MEASURE_CACHE[next(iter(_MEASURE_CACHE))]
+                _MEASURE_CACHE[cache_key] = copy.copy(cmd_result)
         return cmd_result
 
     def dd(self, output, bs=None, count=None, skip=None):
@@ -1663,7 +1928,8 @@ class QemuImg(storage.QemuImg):
         # use 'json:{}' instead when accessing storage with auth
         meta = _get_image_meta(self.tag,
                                self.params,
-                               self.root_dir) if self._need_auth_info(self.tag) else None
+                               self.root_dir,
+                               self.image_filename) if self._need_auth_info(self.tag) else None
         if meta is not None:
             if raw_copy:
                 # drop image secret from meta
@@ -1694,7 +1960,7 @@ class QemuImg(storage.QemuImg):
             cmd_dict["tls_creds_object"] = " ".join(tls_creds_objects)
 
         dd_cmd = self.image_cmd + " " + \
-            self._cmd_formatter.format(self.dd_cmd, **cmd_dict)
+            self._cmd_formatter.vformat(self.dd_cmd, (), cmd_dict)
 
         return process.run(dd_cmd, ignore_status=True)
 
@@ -1719,19 +1985,52 @@ class Iscsidev(storage.Iscsidev):
         """
         super(Iscsidev, self).__init__(params, root_dir, tag)
 
+    def _wait_for_device_name(self, monitor=None):
+        """
+        Wait for the local device of the iscsi target to show up.
+
+        :param monitor: started pyudev monitor of block devices, if given,
+                        the device name is queried again as soon as a block
+                        device event arrives rather than once per second
+        :return: the device name, or None on timeout
+        """
+        if monitor is None:
+            return utils_misc.wait_for(self.iscsidevice.get_device_name,
+                                       self.iscsi_init_timeout)
+
+        end_time = time.monotonic() + float(self.iscsi_init_timeout)
+        while True:
+            device_name = self.iscsidevice.get_device_name()
+            remaining = end_time - time.monotonic()
+            if device_name or remaining <= 0:
+                return device_name or None
+            # an event may come before iscsiadm reports the disk running,
+            # so never wait longer than the polling step
+            monitor.poll(timeout=min(remaining, 1.0))
+
     def setup(self):
         """
         Access the iscsi target. And return the local raw device name.
         """
+        monitor = None
         if self.iscsidevice.logged_in():
             LOG.warn("Session already present. Don't need to login again")
         else:
+            if pyudev is not None:
+                # start monitoring before login, not to miss the disk event
+                try:
+                    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                    monitor.filter_by("block")
+                    monitor.start()
+                except (EnvironmentError, ImportError) as e:
+                    # e.g. no udev netlink or no libudev library in
+                    # containers, poll instead
+                    LOG.debug("Can not monitor udev block events: %s", e)
+                    monitor = None
             self.iscsidevice.login()
 
-        if utils_misc.wait_for(self.iscsidevice.get_device_name,
-                               self.iscsi_init_timeout):
-            device_name = self.iscsidevice.get_device_name()
-        else:
+        device_name = self._wait_for_device_name(monitor)
+        if not device_name:
             raise exceptions.TestError("Can not get iscsi device name in host"
                                        " in %ss" % self.iscsi_init_timeout)
 
@@ -1747,9 +2046,11 @@ class Iscsidev(storage.Iscsidev):
             self.iscsidevice.cleanup()
             if self.emulated_file_remove:
                 LOG.debug("Removing file %s", self.emulated_image)
-                if os.path.exists(self.emulated_image):
+                try:
                     os.unlink(self.emulated_image)
-                else:
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
                     LOG.debug("File %s not found", self.emulated_image)
 
 
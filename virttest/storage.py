@@ -133,9 +133,11 @@ def file_remove(params, filename_path):
     if params.get('image_raw_device') == 'yes':
         return
 
-    if os.path.exists(filename_path):
+    try:
         os.unlink(filename_path)
-        return
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
 
 
 def get_image_blkdebug_filename(params, root_dir):